@@ -1,9 +1,11 @@
-import warnings
-import networkx as nx
 import sys
 import numpy as np
-import cvxpy
+from scipy.optimize import linear_sum_assignment, linprog
+from scipy.sparse import csr_matrix
 import logging
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
@@ -31,121 +33,225 @@ If this assumption holds then there is a room allocation without envy where each
 def max_sum_valuations(valuations):
     """
     Find allocation that maximizes the sum of valuations.
+    This is a linear assignment problem, so we solve it with scipy's linear_sum_assignment.
+    Returns a list of (person index, room index) pairs, sorted by person index.
+    If there are more people than rooms, some people don't get a room and are not in the list.
 
     Examples:
     >>> valuations = [[20, 30, 40], [40, 30, 20], [30, 30, 30]]
     >>> max_sum_valuations(valuations)
-    [('person 0', 'room 2'), ('person 1', 'room 0'), ('person 2', 'room 1')]
+    [(0, 2), (1, 0), (2, 1)]
 
     >>> valuations = [[150,0], [140,10]]
     >>> max_sum_valuations(valuations)
-    [('person 0', 'room 0'), ('person 1', 'room 1')]
-    """
-    G = nx.Graph()
+    [(0, 0), (1, 1)]
 
-    # create edge for every player & object
-    for person in range(len(valuations)):
-        for room in range(len(valuations[person])):
-            G.add_edge(f"person {person}", f"room {room}", weight=valuations[person][room])
+    >>> valuations = [[36, 34, 30, 0], [31, 36, 33, 0], [34, 30, 36, 0], [32, 33, 35, 0]]
+    >>> max_sum_valuations(valuations)
+    [(0, 0), (1, 1), (2, 2), (3, 3)]
 
-    # find maximum-value matching -> allocation that maximizes the valuations
-    alloc = nx.max_weight_matching(G)
-    logger.info("alloc: %s", alloc)
+    >>> valuations = [[10, 20, 30], [30, 20, 10]]
+    >>> max_sum_valuations(valuations)
+    [(0, 2), (1, 0)]
 
-    # Fixing the allocation to always have "person" first and then "room"
-    fixed_alloc = {(person, room) if 'person' in person else (room, person)
-                   for person, room in alloc}
+    More people than rooms, so someone doesn't get a room (the warning is printed to the doctest output):
+    >>> valuations = [[1, 2], [3, 4], [5, 1]]
+    >>> handler = logging.StreamHandler(sys.stdout)
+    >>> logger.addHandler(handler)
+    >>> logger.propagate = False
+    >>> max_sum_valuations(valuations)
+    person 0 couldn't be assigned a room
+    [(1, 1), (2, 0)]
+    >>> logger.propagate = True
+    >>> logger.removeHandler(handler)
+    """
+    # linear_sum_assignment minimizes the cost, so negate the valuations to maximize them
+    cost = -np.asarray(valuations, dtype=np.float64)
+    rows, cols = linear_sum_assignment(cost)
+    logger.info("alloc: %s", list(zip(rows, cols)))
 
     # Check if every person gets a room
-    fixed_alloc = assign_rooms_for_unallocated_people(fixed_alloc, valuations)
+    if len(rows) < len(valuations):
+        for person in sorted(set(range(len(valuations))) - set(rows.tolist())):
+            logger.warning("person %d couldn't be assigned a room", person)
+
+    return [(int(person), int(room)) for person, room in zip(rows, cols)]
+
+
+def get_constraints(valuations, assigned_room, num_rooms, is_assumption_poor_tenants):
+    """
+    Build the constraints of the price LP as a sparse matrix A_ub and vector b_ub such that A_ub @ x <= b_ub,
+    where x = (p[0], ..., p[num_rooms - 1], t) and t is the minimum price.
+    assigned_room[i] is the room that person i gets in the allocation, or -1 if person i didn't get a room
+    (people without a room have no envy-free constraints).
+    For every person i that gets room a and every other room k the envy-free constraint is
+    V[i, a] - p[a] >= V[i, k] - p[k], i.e. p[a] - p[k] <= V[i, a] - V[i, k].
+    Under the assumption of the poor tenants there are no envy-free constraints.
+    For every room k there is also the constraint t <= p[k], i.e. t - p[k] <= 0.
+    """
+    V = np.asarray(valuations, dtype=np.float64)
+    assigned_people = np.flatnonzero(assigned_room >= 0)
+    if is_assumption_poor_tenants:
+        assigned_people = assigned_people[:0]
+
+    # One row for every (assigned person, other room) pair, in the order person by person
+    other_rooms = np.ones((len(assigned_people), num_rooms), dtype=bool)
+    other_rooms[np.arange(len(assigned_people)), assigned_room[assigned_people]] = False
+    rows_of_people, other_room_index = np.nonzero(other_rooms)
+    person_index = assigned_people[rows_of_people]
+    room_index = assigned_room[person_index]
+    num_constraints = len(person_index)
+
+    # +1 at the assigned room and -1 at the other room of every envy-free row,
+    # then +1 at t and -1 at room k of the minimum price rows
+    row = np.arange(num_constraints)
+    min_price_row = np.arange(num_constraints, num_constraints + num_rooms)
+    rooms = np.arange(num_rooms)
+    rows = np.concatenate([row, row, min_price_row, min_price_row])
+    cols = np.concatenate([room_index, other_room_index, np.full(num_rooms, num_rooms), rooms])
+    data = np.concatenate([np.ones(num_constraints), -np.ones(num_constraints),
+                           np.ones(num_rooms), -np.ones(num_rooms)])
+    b_ub = np.concatenate([V[person_index, room_index] - V[person_index, other_room_index], np.zeros(num_rooms)])
+
+    A_ub = csr_matrix((data, (rows, cols)), shape=(num_constraints + num_rooms, num_rooms + 1))
+    return A_ub, b_ub
+
+
+def get_prices_lower_bound(valuations, assigned_room):
+    """
+    Lower bound on the price of every room in any envy-free allocation with prices >= 0
+    (assigned_room[i] is the room of person i, or -1 if person i didn't get a room).
+    If person i gets room a, then V[i, a] - p[a] >= V[i, k] - p[k] and p[a] >= 0 give p[k] >= V[i, k] - V[i, a].
+    So if the sum of these bounds is more than the rent there is no solution and the LP doesn't need to be solved.
+
+    Example:
+    >>> valuations = [[150,0], [140,10]]
+    >>> get_prices_lower_bound(valuations, np.array([0, 1]))
+    array([130.,   0.])
+    """
+    V = np.asarray(valuations, dtype=np.float64)
+    assigned_people = np.flatnonzero(assigned_room >= 0)
+    own_valuations = V[assigned_people, assigned_room[assigned_people]]
+    return (V[assigned_people] - own_valuations[:, None]).max(axis=0, initial=0)
+
+
+# Results of the solved problems by (valuations, rent, is_assumption_poor_tenants, allocation).
+# Only the last _CACHE_SIZE problems that were used are kept.
+_CACHE_SIZE = 128
+_solved_problems = OrderedDict()
 
-    logger.info("fixed_alloc: %s", fixed_alloc)
 
-    return fixed_alloc
+def _to_hashable(valuations, allocation):
+    """
+    Convert the valuations and the allocation to tuples of tuples, so they can be used in the keys of the cache.
+    """
+    return tuple(tuple(row) for row in valuations), tuple(tuple(pair) for pair in allocation)
+
+
+def _get_cached(problem):
+    """
+    Return the cached result of the problem, or None if it wasn't solved yet.
+    """
+    result = _solved_problems.get(problem)
+    if result is not None:
+        _solved_problems.move_to_end(problem)
+    return result
 
 
-def assign_rooms_for_unallocated_people(fixed_alloc, valuations):
+def _store_cached(problem, result):
+    """
+    Store the result of the problem in the cache and drop the least recently used problem if the cache is full.
     """
-        Helper function that get room for person that didn't get and sorted the allocation.
-        nx.max_weight_matching(G) every time return in diffrent order and not allway everyone get a room.
-        Therefor I make sure that every person gets  a room and the order will be increase.
+    _solved_problems[problem] = result
+    _solved_problems.move_to_end(problem)
+    if len(_solved_problems) > _CACHE_SIZE:
+        _solved_problems.popitem(last=False)
 
-        Example:
-        In this example nx.max_weight_matching(G) return {('person 0', 'room 0'), ('person 1', 'room 1'), ('person 2', 'room 2')}
-        so person 3 need to get room 3 and then order the allocation
 
-        >>> valuations = [[36, 34, 30, 0], [31, 36, 33, 0], [34, 30, 36, 0], [32, 33, 35, 0]]
-        >>> fixed_alloc = {('person 0', 'room 0'), ('person 1', 'room 1'), ('person 2', 'room 2')}
-        >>> assign_rooms_for_unallocated_people(fixed_alloc,valuations)
-        [('person 0', 'room 0'), ('person 1', 'room 1'), ('person 2', 'room 2'), ('person 3', 'room 3')]
+def _solve(valuations, rent, is_assumption_poor_tenants, allocation):
+    """
+    Find the envy-free prices of the allocation and return the results as the text to print.
+    The allocation is computed by the caller, so its logs (and warnings) are shown on every call,
+    and the caller takes care of caching the results.
     """
+    num_rooms = len(valuations[0])
     num_people = len(valuations)
-    allocated_people = {person for person, _ in fixed_alloc}
-
-    for person in range(num_people):
-        if f"person {person}" not in allocated_people:
-            available_rooms = [f"room {room}" for room in range(len(valuations[0]))]
-            for _, room in fixed_alloc:
-                if room in available_rooms:
-                    available_rooms.remove(room)
-            if available_rooms:
-                fixed_alloc.add((f"person {person}", available_rooms[0]))
-                logger.info("person %d assigned to room %d", person, int(available_rooms[0].split()[1]))
-            else:
-                logger.warning("person %d couldn't be assigned a room", person)
-
-    # Sort fixed_alloc based on person indices
-    fixed_alloc = sorted(fixed_alloc, key=lambda x: int(x[0].split()[1]))
-    return fixed_alloc
-
-
-def get_constraints(valuations, rent, allocation, num_rooms, price_rooms, is_assumption_poor_tenants):
-    # The sum of the prices should be equal to the rent
-    constraints = [sum(price_rooms) == rent]
-
-    # Prices need to be >= 0
-    constraints.extend([price >= 0 for price in price_rooms])
-
-    # Envy-free constraints for each person
-    for person, room in allocation:
-        person_index = int(person.split()[1])
-        room_index = int(room.split()[1])
-        for other_room_index in range(num_rooms):
-            if other_room_index != room_index:
-                if is_assumption_poor_tenants:
-                    if price_rooms[room_index].value == 0:
-                        constraints.append(price_rooms[other_room_index] == 0)
-                else:
-                    constraints.append(
-                        valuations[person_index][room_index] - price_rooms[room_index] >= valuations[person_index][
-                            other_room_index] - price_rooms[other_room_index])
-
-    return constraints
+
+    # The room of every person (-1 for people without a room), computed once and used for the constraints
+    # and for the printing
+    assigned_room = np.full(num_people, -1, dtype=np.int64)
+    for person_index, room_index in allocation:
+        assigned_room[person_index] = room_index
+
+    # Cheap check before solving: the rent must cover the minimal envy-free prices
+    if not is_assumption_poor_tenants and get_prices_lower_bound(valuations, assigned_room).sum() > rent:
+        return "Can not find allocation with prices >= 0"
+
+    A_ub, b_ub = get_constraints(valuations, assigned_room, num_rooms, is_assumption_poor_tenants)
+
+    # The sum of the prices should be equal to the rent and the prices need to be >= 0.
+    # Among these prices, maximize the minimum price t (minimize -t) so the most balanced prices are chosen
+    # instead of an arbitrary vertex, and solve the LP directly with HiGHS
+    c = np.zeros(num_rooms + 1)
+    c[-1] = -1
+    A_eq = np.ones((1, num_rooms + 1))
+    A_eq[0, -1] = 0
+    res = linprog(c=c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=[rent],
+                  bounds=[(0, None)] * (num_rooms + 1), method="highs")
+
+    # Format the results
+    if res.status != 0:
+        return "Can not find allocation with prices >= 0"
+
+    # Under the assumption of the poor tenants every tenant pays a positive price
+    # (with a small tolerance, since the minimum price t comes from the solver)
+    if is_assumption_poor_tenants and res.x[-1] <= 1e-9:
+        return "Can not find allocation with prices > 0"
+
+    lines = ["Allocation:"]
+    for person_index in np.flatnonzero(assigned_room >= 0):
+        room_index = assigned_room[person_index]
+        lines.append(f"person {person_index} gets room {room_index}")
+    # Round all the prices in one call and format them as python floats
+    prices = np.round(res.x[:num_rooms]).tolist()
+    lines.extend(f"Room {i} rent: {price}" for i, price in enumerate(prices))
+    return "\n".join(lines)
 
 
 # Step 2: Determine the prices such that the allocation will be envy-free
-def find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenants):
+def find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenants, allocation=None):
     """
     Find the prices such that the allocation will be envy-free and every person pays price >= 0.
+    Among these prices the ones with the largest minimum price are chosen, and under the assumption of
+    the poor tenants every person pays a positive price.
+    If there are no such prices it prints "Can not find allocation with prices >= 0"
+    ("Can not find allocation with prices > 0" under the assumption of the poor tenants).
+    An allocation that was already computed by max_sum_valuations can be passed to avoid computing it again.
 
     Examples:
     >>> valuations = [[20, 30, 40], [40, 30, 20], [30, 30, 30]]
     >>> rent = 90
     >>> is_assumption_poor_tenants = False
     >>> find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenants)
-    Allocation: [('person 0', 'room 2'), ('person 1', 'room 0'), ('person 2', 'room 1')]
-    Room 0 rent: 31.0
-    Room 1 rent: 27.0
-    Room 2 rent: 31.0
+    Allocation:
+    person 0 gets room 2
+    person 1 gets room 0
+    person 2 gets room 1
+    Room 0 rent: 30.0
+    Room 1 rent: 30.0
+    Room 2 rent: 30.0
 
     >>> valuations = [[25, 40, 35], [40, 60, 35], [20, 40, 25]]
     >>> rent = 50
     >>> is_assumption_poor_tenants = False
     >>> find_rent_with_nonnegative_prices(valuations, rent,is_assumption_poor_tenants)
-    Allocation: [('person 0', 'room 2'), ('person 1', 'room 1'), ('person 2', 'room 0')]
+    Allocation:
+    person 0 gets room 2
+    person 1 gets room 1
+    person 2 gets room 0
     Room 0 rent: 8.0
     Room 1 rent: 28.0
-    Room 2 rent: 15.0
+    Room 2 rent: 13.0
 
 
     >>> valuations = [[150,0], [140,10]]
@@ -165,7 +271,9 @@ def find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenan
     >>> rent = 100
     >>> is_assumption_poor_tenants = True
     >>> find_rent_with_nonnegative_prices(valuations, rent,is_assumption_poor_tenants)
-    Allocation: [('person 0', 'room 0'), ('person 1', 'room 1')]
+    Allocation:
+    person 0 gets room 0
+    person 1 gets room 1
     Room 0 rent: 50.0
     Room 1 rent: 50.0
 
@@ -173,7 +281,11 @@ def find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenan
     >>> rent = 100
     >>> is_assumption_poor_tenants = True
     >>> find_rent_with_nonnegative_prices(valuations, rent,is_assumption_poor_tenants)
-    Allocation: [('person 0', 'room 0'), ('person 1', 'room 1'), ('person 2', 'room 2'), ('person 3', 'room 3')]
+    Allocation:
+    person 0 gets room 0
+    person 1 gets room 1
+    person 2 gets room 2
+    person 3 gets room 3
     Room 0 rent: 25.0
     Room 1 rent: 25.0
     Room 2 rent: 25.0
@@ -183,37 +295,92 @@ def find_rent_with_nonnegative_prices(valuations, rent, is_assumption_poor_tenan
     >>> rent = 95
     >>> is_assumption_poor_tenants = True
     >>> find_rent_with_nonnegative_prices(valuations, rent,is_assumption_poor_tenants)
-    Allocation: [('person 0', 'room 0'), ('person 1', 'room 1')]
-    Room 0 rent: 47.0
+    Allocation:
+    person 0 gets room 0
+    person 1 gets room 1
+    Room 0 rent: 48.0
     Room 1 rent: 48.0
+
+    >>> valuations = [[100, 0], [50, 50]]
+    >>> rent = 0
+    >>> is_assumption_poor_tenants = True
+    >>> find_rent_with_nonnegative_prices(valuations, rent,is_assumption_poor_tenants)
+    Can not find allocation with prices > 0
+
+    >>> valuations = [[20, 30, 40], [40, 30, 20], [30, 30, 30]]
+    >>> allocation = max_sum_valuations(valuations)
+    >>> find_rent_with_nonnegative_prices(valuations, 90, False, allocation)
+    Allocation:
+    person 0 gets room 2
+    person 1 gets room 0
+    person 2 gets room 1
+    Room 0 rent: 30.0
+    Room 1 rent: 30.0
+    Room 2 rent: 30.0
+
+    >>> valuations = [[1, 2], [3, 4], [5, 1]]
+    >>> allocation = [(1, 1), (2, 0)]
+    >>> find_rent_with_nonnegative_prices(valuations, 3, False, allocation)
+    Allocation:
+    person 1 gets room 1
+    person 2 gets room 0
+    Room 0 rent: 2.0
+    Room 1 rent: 2.0
     """
 
-    allocation = max_sum_valuations(valuations)
+    if allocation is None:
+        allocation = max_sum_valuations(valuations)
+    valuations, allocation = _to_hashable(valuations, allocation)
+    problem = (valuations, rent, is_assumption_poor_tenants, allocation)
+    result = _get_cached(problem)
+    if result is None:
+        result = _solve(*problem)
+        _store_cached(problem, result)
+    else:
+        # Repeated problems are taken from the cache, so the logs of solving the LP are not shown again
+        logger.info("Using the cached result for valuations %s and rent %s", valuations, rent)
+    print(result)
 
-    num_rooms = len(valuations[0])
-    num_people = len(valuations)
-    price_rooms = [cvxpy.Variable() for _ in range(num_rooms)]
 
-    constraints = get_constraints(valuations, rent, allocation, num_rooms, price_rooms, is_assumption_poor_tenants)
+def solve_many(problems):
+    """
+    Solve many independent problems in parallel, with up to one process per cpu.
+    Every problem is a tuple (valuations, rent, is_assumption_poor_tenants) and the result of every problem
+    is the text that find_rent_with_nonnegative_prices prints for it.
+    The allocations are computed here, then only the problems that are not in the cache are sent (once each)
+    to the worker processes, and their results are stored in the cache.
+
+    Example:
+    >>> problems = [([[150,0], [140,10]], 100, False), ([[150,0], [140,10]], 100, True),
+    ...             ([[150,0], [140,10]], 100, False)]
+    >>> for result in solve_many(problems):
+    ...     print(result)
+    Can not find allocation with prices >= 0
+    Allocation:
+    person 0 gets room 0
+    person 1 gets room 1
+    Room 0 rent: 50.0
+    Room 1 rent: 50.0
+    Can not find allocation with prices >= 0
+    """
+    keys = []
+    for valuations, rent, is_assumption_poor_tenants in problems:
+        valuations, allocation = _to_hashable(valuations, max_sum_valuations(valuations))
+        keys.append((valuations, rent, is_assumption_poor_tenants, allocation))
 
-    prob = cvxpy.Problem(cvxpy.Minimize(0), constraints)
-    # Explicitly specify the solver to use for not showing the red warnings
-    prob.solve(solver=cvxpy.ECOS)
+    # Every different problem once, with its cached result (None if it wasn't solved yet)
+    results = {key: _get_cached(key) for key in keys}
+    missing = [key for key, result in results.items() if result is None]
+    if missing:
+        with Pool(processes=min(len(missing), os.cpu_count() or 1)) as pool:
+            for key, result in zip(missing, pool.starmap(_solve, missing)):
+                results[key] = result
+                _store_cached(key, result)
 
-    # Print the results
-    if prob.status == 'optimal':
-        print("Allocation:", allocation)
-        logger.info("Prices:")
-        for i in range(num_rooms):
-            print(f"Room {i} rent: {np.round(price_rooms[i].value)}")
-    else:
-        print("Can not find allocation with prices >= 0")
+    return [results[key] for key in keys]
 
 
 if __name__ == '__main__':
-    warnings.filterwarnings("ignore", message="Your problem is being solved with the ECOS solver by default.",
-                            category=FutureWarning)
-
     import doctest
     doctest.testmod()
 